@@ -8,12 +8,27 @@ Backend which facilitates the conversion operations
 from collections.abc import Mapping
 import json
 import logging
+import math
 import os
+import threading
 
 from forex_python import converter
 
+from currencyconv import fetch, shmcache
+
 logger = logging.getLogger(__name__)
 
+# environment variable overriding the base URL of the rate API, e.g. to point
+# the stack at `currencyconv.fakeserver`
+RATES_URL_ENV = 'CURRENCYCONV_RATES_URL'
+# timeout of a single request to the rate API in seconds
+TIMEOUT_ENV = 'CURRENCYCONV_TIMEOUT'
+# number of retries of failed requests to the rate API
+RETRIES_ENV = 'CURRENCYCONV_RETRIES'
+# name of the host-wide shared memory rate cache, rates are not shared between
+# processes if unset
+SHM_CACHE_ENV = 'CURRENCYCONV_SHM_CACHE'
+
 
 class ConversionError(Exception):
     """
@@ -32,6 +47,21 @@ class InputCurrencySameAsOutput(ConversionError):
     pass
 
 
+class RatesNotAvailable(ConversionError):
+    """
+    Raised when the rates could not be retrieved due to upstream or network
+    failure
+    """
+    pass
+
+
+class ConfigurationError(ConversionError):
+    """
+    Raised when the environment holds invalid configuration
+    """
+    pass
+
+
 class Converter:
     """
     Class which facilitates the conversion of a currency `base` to other
@@ -81,15 +111,125 @@ class Converter:
             amount, output_currencies)}
 
 
+def _parse_env_value(name, value, type_, minimum):
+    """
+    parse numeric configuration value of environment variable `name`
+
+    :raises: ConfigurationError if the value is not a finite number of
+        `type_` or is lower than `minimum`
+    """
+    try:
+        parsed = type_(value)
+    except ValueError:
+        parsed = None
+
+    if parsed is None or not math.isfinite(parsed) or parsed < minimum:
+        raise ConfigurationError(
+            "Invalid value of {} environment variable: '{}'".format(
+                name, value))
+
+    return parsed
+
+
+_default_fetcher = None
+_default_fetcher_env = None
+_default_fetcher_lock = threading.Lock()
+
+
+def default_fetcher():
+    """
+    Return process-wide rate fetcher configured from the environment
+    (`RATES_URL_ENV`, `TIMEOUT_ENV`, `RETRIES_ENV`). The fetcher is shared
+    so that its cache and circuit breaker state outlive individual
+    converters. Its `stats` attribute exposes the instrumentation counters.
+
+    :raises: ConfigurationError if the timeout or retries are malformed
+    """
+    global _default_fetcher, _default_fetcher_env
+
+    env = (os.environ.get(RATES_URL_ENV), os.environ.get(TIMEOUT_ENV),
+           os.environ.get(RETRIES_ENV))
+
+    with _default_fetcher_lock:
+        if _default_fetcher is not None and _default_fetcher_env == env:
+            return _default_fetcher
+
+        source_url, timeout, retries = env
+        source_url = source_url or converter.CurrencyRates()._source_url()
+        timeout = (5.0 if timeout is None else
+                   _parse_env_value(TIMEOUT_ENV, timeout, float, 0.001))
+        retries = (2 if retries is None else
+                   _parse_env_value(RETRIES_ENV, retries, int, 0))
+
+        logger.debug("Initializing rate fetcher for %s", source_url)
+        _default_fetcher = fetch.RateFetcher(
+            source_url, timeout=timeout, retries=retries)
+        _default_fetcher_env = env
+
+    return _default_fetcher
+
+
+_default_shared_cache = None
+
+
+def default_shared_cache():
+    """
+    Return process-wide handle of the shared memory rate cache named by
+    `SHM_CACHE_ENV`, or None if the cache is not configured
+
+    :raises: ConfigurationError if the cache name is invalid
+    """
+    global _default_shared_cache
+
+    name = os.environ.get(SHM_CACHE_ENV)
+    if not name:
+        return None
+
+    fetcher = default_fetcher()
+    with _default_fetcher_lock:
+        cache = _default_shared_cache
+        if cache is None or (cache.name, cache.fetcher) != (name, fetcher):
+            logger.debug("Attaching to shared rate cache '%s'", name)
+            try:
+                cache = shmcache.SharedRateCache(fetcher, name=name)
+            except ValueError as e:
+                raise ConfigurationError(
+                    "Invalid value of {} environment variable: {}".format(
+                        SHM_CACHE_ENV, e))
+
+            if _default_shared_cache is not None:
+                _default_shared_cache.close()
+            _default_shared_cache = cache
+
+    return cache
+
+
+def default_rates_source():
+    """
+    Return the shared memory rate cache if configured, the process-wide rate
+    fetcher otherwise
+    """
+    cache = default_shared_cache()
+    if cache is not None:
+        return cache
+
+    return default_fetcher()
+
+
 def default_converter(base):
     """
-    Return default converter which uses forex_python (frontend to fixer.io
-    rates)
+    Return default converter which uses rates fetched from the rate API
+    (theratesapi.com unless overriden by `RATES_URL_ENV`)
+
+    :raises: UnknownCurrencyCode if the rate API does not know the base
+        currency, RatesNotAvailable if the rates could not be fetched
     """
     try:
-        return Converter(base, converter.CurrencyRates().get_rates(base))
-    except converter.RatesNotAvailableError:
+        return Converter(base, default_rates_source().get_rates(base))
+    except fetch.UnknownBase:
         raise UnknownCurrencyCode(base)
+    except fetch.UpstreamUnavailable as e:
+        raise RatesNotAvailable(str(e)) from e
 
 
 def _parse_raw_currency_data():
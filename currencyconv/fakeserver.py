@@ -0,0 +1,312 @@
+# Author: Martin Babinsky <martbab@gmail.com>
+# See LICENSE file for license
+
+"""
+Local stand-in for the upstream rate server
+
+Serves deterministic fixture rate tables using the same URL layout and JSON
+format the upstream API uses, so the whole stack can be pointed at it (see
+`backend.RATES_URL_ENV`) and exercised offline. Latency, error rate and rate
+limiting are configurable in order to reproduce upstream misbehavior.
+"""
+
+import argparse
+from http import server
+import json
+import logging
+import random
+import threading
+import time
+from urllib import parse
+
+logger = logging.getLogger(__name__)
+
+# reference rates against EUR, loosely based on the ECB reference rates
+FIXTURE_EUR_RATES = {
+    "AUD": 1.6432,
+    "BGN": 1.9558,
+    "BRL": 5.3911,
+    "CAD": 1.4721,
+    "CHF": 0.9732,
+    "CNY": 7.8256,
+    "CZK": 25.286,
+    "DKK": 7.4604,
+    "EUR": 1.0,
+    "GBP": 0.8561,
+    "HKD": 8.4811,
+    "HUF": 391.08,
+    "IDR": 17021.73,
+    "ILS": 4.0148,
+    "INR": 90.4405,
+    "ISK": 149.9,
+    "JPY": 162.54,
+    "KRW": 1466.81,
+    "MXN": 19.4727,
+    "MYR": 5.1035,
+    "NOK": 11.6265,
+    "NZD": 1.7946,
+    "PHP": 61.744,
+    "PLN": 4.3245,
+    "RON": 4.9733,
+    "SEK": 11.4905,
+    "SGD": 1.4408,
+    "THB": 39.207,
+    "TRY": 35.5236,
+    "USD": 1.0876,
+    "ZAR": 19.6502,
+}
+
+
+class RateTable:
+    """
+    Deterministic table of conversion rates
+
+    :param eur_rates: dictionary of rates against EUR keyed by 3-letter
+        currency code. Cross rates for other bases are derived from it
+    """
+    def __init__(self, eur_rates=None):
+        if eur_rates is None:
+            eur_rates = FIXTURE_EUR_RATES
+
+        self.eur_rates = dict(eur_rates)
+
+    def __contains__(self, code):
+        return code in self.eur_rates
+
+    @property
+    def codes(self):
+        return sorted(self.eur_rates)
+
+    def get_rates(self, base):
+        """
+        return the rates of all known currencies (except the base itself)
+        against the base currency
+
+        :raises: KeyError if the base currency is not in the table
+        """
+        base_rate = self.eur_rates[base]
+        return {code: rate / base_rate for code, rate in
+                self.eur_rates.items() if code != base}
+
+
+class _RequestHandler(server.BaseHTTPRequestHandler):
+    """
+    Handle `GET <prefix>/<date|latest>?base=<code>` requests
+    """
+    def do_GET(self):
+        fake_server = self.server.fake_server
+        status, payload, headers = fake_server.handle(self.path)
+
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+
+class FakeRateServer:
+    """
+    In-process HTTP server serving fixture rate tables
+
+    :param table: `RateTable` to serve, the default fixture table is used if
+        not specified
+    :param latency: delay in seconds added to every response
+    :param error_rate: fraction (0.0 - 1.0) of requests which fail with
+        HTTP 503
+    :param rate_limit: maximum number of requests accepted per
+        `rate_limit_window`, excess requests get HTTP 429. No limit if None
+    :param rate_limit_window: length of the rate limiting window in seconds
+    :param seed: seed for the random generator deciding which requests fail
+    :param host: address to bind to
+    :param port: port to bind to, 0 picks a free port
+    """
+    def __init__(self, table=None, latency=0.0, error_rate=0.0,
+                 rate_limit=None, rate_limit_window=1.0, seed=None,
+                 host='127.0.0.1', port=0):
+        self.table = table if table is not None else RateTable()
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.rate_limit_window = rate_limit_window
+
+        self.request_count = 0
+        self.error_count = 0
+        self.rate_limited_count = 0
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._window_start = time.monotonic()
+        self._window_count = 0
+
+        self._httpd = server.ThreadingHTTPServer((host, port), _RequestHandler)
+        self._httpd.daemon_threads = True
+        self._httpd.fake_server = self
+        self._thread = None
+
+    @property
+    def url(self):
+        """
+        base URL of the rate API, suitable for `backend.RATES_URL_ENV`
+        """
+        host, port = self._httpd.server_address[:2]
+        return "http://{}:{}/api/".format(host, port)
+
+    def _check_rate_limit(self):
+        now = time.monotonic()
+        if now - self._window_start >= self.rate_limit_window:
+            self._window_start = now
+            self._window_count = 0
+
+        self._window_count += 1
+        return self._window_count <= self.rate_limit
+
+    def handle(self, path):
+        """
+        compute the response to the request for `path`
+
+        :returns: tuple of HTTP status, JSON payload and extra headers
+        """
+        with self._lock:
+            self.request_count += 1
+
+            if self.rate_limit is not None and not self._check_rate_limit():
+                self.rate_limited_count += 1
+                retry_after = str(max(1, round(self.rate_limit_window)))
+                return (429, {'error': 'Too many requests'},
+                        {'Retry-After': retry_after})
+
+            failed = self._random.random() < self.error_rate
+            if failed:
+                self.error_count += 1
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        if failed:
+            return 503, {'error': 'Service unavailable'}, {}
+
+        url = parse.urlsplit(path)
+        date = url.path.rstrip('/').rsplit('/', 1)[-1]
+        base = parse.parse_qs(url.query).get('base', ['EUR'])[0]
+
+        try:
+            rates = self.table.get_rates(base)
+        except KeyError:
+            return 400, {'error': "Base '{}' is not supported.".format(
+                base)}, {}
+
+        return 200, {'base': base, 'date': date, 'rates': rates}, {}
+
+    def start(self):
+        """
+        start serving requests in a background thread
+        """
+        self._thread = threading.Thread(
+            target=self._httpd.serve_forever, kwargs={'poll_interval': 0.05},
+            name='fake-rate-server', daemon=True)
+        self._thread.start()
+        logger.debug("Fake rate server listening on %s", self.url)
+        return self
+
+    def serve_forever(self):
+        """
+        serve requests in the current thread until interrupted
+        """
+        self._httpd.serve_forever()
+
+    def stop(self):
+        """
+        stop the server and release the listening socket
+        """
+        if self._thread is not None:
+            self._httpd.shutdown()
+            self._thread.join()
+            self._thread = None
+
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(
+        description="Serve fixture conversion rates over HTTP")
+    parser.add_argument(
+        '--host',
+        default='127.0.0.1',
+        help="Address to bind to"
+    )
+    parser.add_argument(
+        '-p',
+        '--port',
+        type=int,
+        default=8000,
+        help="Port to listen on"
+    )
+    parser.add_argument(
+        '--latency',
+        type=float,
+        default=0.0,
+        help="Delay added to every response in seconds"
+    )
+    parser.add_argument(
+        '--error-rate',
+        type=float,
+        default=0.0,
+        help="Fraction of requests failing with HTTP 503"
+    )
+    parser.add_argument(
+        '--rate-limit',
+        type=int,
+        default=None,
+        help="Maximum number of requests per rate limit window"
+    )
+    parser.add_argument(
+        '--rate-limit-window',
+        type=float,
+        default=1.0,
+        help="Length of the rate limit window in seconds"
+    )
+    parser.add_argument(
+        '--seed',
+        type=int,
+        default=None,
+        help="Seed of the random generator deciding which requests fail"
+    )
+    return parser
+
+
+def main(args=None):
+    args = make_parser().parse_args(args=args)
+    logging.basicConfig(level=logging.DEBUG)
+
+    fake_server = FakeRateServer(
+        latency=args.latency,
+        error_rate=args.error_rate,
+        rate_limit=args.rate_limit,
+        rate_limit_window=args.rate_limit_window,
+        seed=args.seed,
+        host=args.host,
+        port=args.port)
+
+    print("Serving fixture rates on {}".format(fake_server.url))
+    try:
+        fake_server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        fake_server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,408 @@
+# Author: Martin Babinsky <martbab@gmail.com>
+# See LICENSE file for license
+
+"""
+Resilient fetching of rate tables from the upstream rate API
+
+Every request is bounded by a timeout, transient failures are retried with
+jittered exponential backoff and a circuit breaker stops hammering an upstream
+which keeps failing. Fetched tables are cached and served
+stale-while-revalidate: once a table gets older than `max_age` it is still
+returned immediately while a fresh copy is fetched in the background.
+"""
+
+import logging
+import random
+import threading
+import time
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+# HTTP statuses the rate API uses to reject an unknown base currency
+UNKNOWN_BASE_STATUSES = (400, 422)
+
+
+class FetchError(Exception):
+    """
+    Base class for the errors during fetching of rates
+    """
+    pass
+
+
+class UnknownBase(FetchError):
+    """
+    Raised when the upstream does not know the requested base currency
+    """
+    pass
+
+
+class UpstreamUnavailable(FetchError):
+    """
+    Raised when the rates could not be fetched due to upstream or network
+    failure
+    """
+    pass
+
+
+class UpstreamRejected(UpstreamUnavailable):
+    """
+    Raised when the upstream refused the request for other reason than an
+    unknown base currency, e. g. wrong URL or missing authorization. Such
+    requests are not retried
+    """
+    pass
+
+
+class CircuitOpen(UpstreamUnavailable):
+    """
+    Raised when the request was not even attempted because the circuit breaker
+    is open
+    """
+    pass
+
+
+class FetchStats:
+    """
+    Thread-safe counters describing the behavior of the fetch layer
+
+    * requests: HTTP requests sent upstream
+    * retries: requests which were retries of a failed one
+    * failures: fetches which failed after exhausting all retries
+    * fresh_hits: lookups served from a fresh cache entry
+    * stale_hits: lookups served from a stale cache entry while revalidating
+    * fallbacks: lookups served from cache because the upstream failed
+    * refreshes: background revalidations started
+    * circuit_rejections: fetches rejected by the open circuit breaker
+    """
+    FIELDS = ('requests', 'retries', 'failures', 'fresh_hits', 'stale_hits',
+              'fallbacks', 'refreshes', 'circuit_rejections')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = dict.fromkeys(self.FIELDS, 0)
+
+    def increment(self, field):
+        with self._lock:
+            self._counts[field] += 1
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__['_counts'][name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def as_dict(self):
+        with self._lock:
+            return dict(self._counts)
+
+
+class CircuitBreaker:
+    """
+    Fail fast when the upstream keeps failing
+
+    After `failure_threshold` consecutive failures the circuit opens and all
+    requests are rejected for `reset_timeout` seconds. Then a single trial
+    request is let through (half-open state): its success closes the circuit
+    again, its failure re-opens it.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0,
+                 clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state()
+
+    def _state(self):
+        if self._opened_at is None:
+            return self.CLOSED
+
+        if self.clock() - self._opened_at < self.reset_timeout:
+            return self.OPEN
+
+        return self.HALF_OPEN
+
+    def allow(self):
+        """
+        return True if a request may be sent upstream
+        """
+        with self._lock:
+            state = self._state()
+            if state == self.CLOSED:
+                return True
+
+            if state == self.HALF_OPEN and not self._trial_running:
+                self._trial_running = True
+                return True
+
+            return False
+
+    def would_allow(self):
+        """
+        return True if `allow` would let a request through, without taking
+        the half-open trial
+        """
+        with self._lock:
+            state = self._state()
+            return (state == self.CLOSED or
+                    state == self.HALF_OPEN and not self._trial_running)
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_running = False
+            if (self._opened_at is not None or
+                    self._failures >= self.failure_threshold):
+                if self._opened_at is None:
+                    logger.warning(
+                        "Upstream failed %d times in a row, opening circuit "
+                        "for %.1f s", self._failures, self.reset_timeout)
+                self._opened_at = self.clock()
+
+
+class _CacheEntry:
+    def __init__(self, rates, fetched_at):
+        self.rates = rates
+        self.fetched_at = fetched_at
+
+
+class RateFetcher:
+    """
+    Fetch rate tables from the upstream rate API
+
+    :param source_url: base URL of the rate API
+    :param timeout: timeout of a single HTTP request in seconds
+    :param retries: number of retries of a failed request
+    :param backoff: base delay before the first retry in seconds. The delay
+        doubles with each retry and the actual sleep is drawn uniformly from
+        [0, delay] (full jitter)
+    :param max_backoff: upper bound of the delay between retries
+    :param max_age: age in seconds after which the cached table is
+        revalidated
+    :param max_stale: how long past `max_age` the cached table may still be
+        served while revalidating
+    :param circuit_breaker: `CircuitBreaker` instance, a default one is created
+        if not specified
+    """
+    def __init__(self, source_url, timeout=5.0, retries=2, backoff=0.1,
+                 max_backoff=2.0, max_age=3600.0, max_stale=86400.0,
+                 circuit_breaker=None, clock=time.monotonic, sleep=time.sleep,
+                 rng=None):
+        self.source_url = source_url
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_age = max_age
+        self.max_stale = max_stale
+        self.circuit_breaker = (
+            circuit_breaker if circuit_breaker is not None
+            else CircuitBreaker(clock=clock))
+        self.clock = clock
+        self.sleep = sleep
+        self.stats = FetchStats()
+
+        self._rng = rng if rng is not None else random.Random()
+        self._session = requests.Session()
+        self._cache = {}
+        self._lock = threading.Lock()
+        self._base_locks = {}
+        self._refreshing = set()
+
+    def _request(self, base):
+        """
+        send a single request upstream
+
+        :returns: rate dictionary
+        :raises: UnknownBase if the upstream rejected the base currency,
+            UpstreamUnavailable on transient failures
+        """
+        self.stats.increment('requests')
+        try:
+            response = self._session.get(
+                self.source_url + 'latest',
+                params={'base': base, 'rtype': 'fpy'},
+                timeout=self.timeout)
+        except requests.RequestException as e:
+            raise UpstreamUnavailable(
+                "Request to rate API failed: {}".format(e))
+
+        if response.status_code == 429 or response.status_code >= 500:
+            raise UpstreamUnavailable(
+                "Rate API responded with HTTP {}".format(
+                    response.status_code))
+
+        if response.status_code in UNKNOWN_BASE_STATUSES:
+            raise UnknownBase(base)
+
+        if response.status_code != 200:
+            raise UpstreamRejected(
+                "Rate API responded with HTTP {}".format(
+                    response.status_code))
+
+        try:
+            return response.json()['rates']
+        except (ValueError, KeyError, TypeError) as e:
+            raise UpstreamUnavailable(
+                "Malformed response from rate API: {}".format(e))
+
+    def _retry_delay(self, attempt):
+        delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+        return self._rng.uniform(0, delay)
+
+    def fetch(self, base):
+        """
+        fetch the rates for `base` from upstream bypassing the cache, retrying
+        on transient failures. The result is stored in the cache.
+
+        :raises: UnknownBase if the upstream does not know the base currency,
+            UpstreamUnavailable if the rates could not be fetched
+        """
+        attempt = 0
+        while True:
+            if not self.circuit_breaker.allow():
+                self.stats.increment('circuit_rejections')
+                if attempt:
+                    # the circuit opened while retrying a failed request
+                    self.stats.increment('failures')
+                raise CircuitOpen("Circuit breaker is open, not contacting "
+                                  "the rate API")
+
+            try:
+                rates = self._request(base)
+            except UnknownBase:
+                self.circuit_breaker.record_success()
+                raise
+            except UpstreamUnavailable as e:
+                self.circuit_breaker.record_failure()
+                if (attempt >= self.retries or
+                        isinstance(e, UpstreamRejected)):
+                    self.stats.increment('failures')
+                    raise
+
+                delay = self._retry_delay(attempt)
+                logger.debug("%s, retrying in %.3f s", e, delay)
+                self.sleep(delay)
+                self.stats.increment('retries')
+                attempt += 1
+            else:
+                self.circuit_breaker.record_success()
+                break
+
+        with self._lock:
+            self._cache[base] = _CacheEntry(rates, self.clock())
+
+        return rates
+
+    def _base_lock(self, base):
+        with self._lock:
+            return self._base_locks.setdefault(base, threading.Lock())
+
+    def _refresh(self, base):
+        try:
+            self.fetch(base)
+        except FetchError as e:
+            logger.warning("Background refresh of '%s' rates failed: %s",
+                           base, e)
+        finally:
+            with self._lock:
+                self._refreshing.discard(base)
+
+    def refresh_in_background(self, base):
+        """
+        start fetching `base` rates in a background thread unless there is one
+        already running or the circuit breaker would reject it
+
+        :returns: the started thread or None
+        """
+        if not self.circuit_breaker.would_allow():
+            self.stats.increment('circuit_rejections')
+            return None
+
+        with self._lock:
+            if base in self._refreshing:
+                return None
+            self._refreshing.add(base)
+
+        self.stats.increment('refreshes')
+        thread = threading.Thread(
+            target=self._refresh, args=(base,),
+            name='rate-refresh-{}'.format(base), daemon=True)
+        thread.start()
+        return thread
+
+    def _lookup(self, base):
+        """
+        return cached rates for `base` if they are fresh or may be served
+        stale, None otherwise
+        """
+        entry = self._cache.get(base)
+        if entry is None:
+            return None
+
+        age = self.clock() - entry.fetched_at
+        if age < self.max_age:
+            self.stats.increment('fresh_hits')
+            return entry.rates
+
+        if age < self.max_age + self.max_stale:
+            self.stats.increment('stale_hits')
+            logger.debug("Serving '%s' rates %.0f s old while revalidating",
+                         base, age)
+            self.refresh_in_background(base)
+            return entry.rates
+
+        return None
+
+    def get_rates(self, base):
+        """
+        return the rates for `base`, preferably from cache. If the upstream
+        fails and there are cached rates of any age, they are served instead.
+
+        :raises: UnknownBase if the upstream does not know the base currency,
+            UpstreamUnavailable if the rates could not be fetched and there
+            is nothing cached
+        """
+        rates = self._lookup(base)
+        if rates is not None:
+            return rates
+
+        # let only a single thread fetch the given base, the others wait for
+        # it and pick up the result from cache
+        with self._base_lock(base):
+            rates = self._lookup(base)
+            if rates is not None:
+                return rates
+
+            try:
+                return self.fetch(base)
+            except UpstreamUnavailable as e:
+                entry = self._cache.get(base)
+                if entry is None:
+                    raise
+
+                self.stats.increment('fallbacks')
+                logger.warning(
+                    "%s, falling back to '%s' rates fetched %.0f s ago",
+                    e, base, self.clock() - entry.fetched_at)
+                return entry.rates
@@ -0,0 +1,464 @@
+# Author: Martin Babinsky <martbab@gmail.com>
+# See LICENSE file for license
+
+"""
+Load-testing driver
+
+Replays a synthetic or recorded mix of conversion queries against the library,
+the CLI or the rate server at a target rate, using a pool of threads or
+asyncio tasks, and reports throughput and latency percentiles as JSON. Unless
+an explicit rate API URL is given, the queries run against an in-process
+`fakeserver.FakeRateServer`, so the whole run is offline and reproducible.
+
+Latency is measured from the moment a query was scheduled to be sent, so
+that queueing caused by a saturated system is accounted for. Service time is
+measured from the moment the query actually started executing.
+"""
+
+import argparse
+import asyncio
+from concurrent import futures
+import json
+import logging
+import math
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+
+from currencyconv import app, backend, fakeserver, fetch
+
+logger = logging.getLogger(__name__)
+
+# symbols which resolve to a single currency known to the fixture rates
+UNIQUE_SYMBOLS = {
+    'Kč': 'CZK',
+    '€': 'EUR',
+    'zł': 'PLN',
+    'Ft': 'HUF',
+}
+# symbols resolving to multiple currencies
+AMBIGUOUS_SYMBOLS = ['$', '£', '¥']
+
+
+def synthetic_queries(count, codes=None, ambiguous_ratio=0.1,
+                      all_outputs_ratio=0.1, seed=None):
+    """
+    generate a list of random queries. Each query is a dictionary with
+    `amount`, `input` (currency code or symbol) and `output` (currency code,
+    symbol or None for all currencies) keys
+
+    :param count: number of queries
+    :param codes: currency codes to choose from, fixture codes by default
+    :param ambiguous_ratio: fraction of queries using ambiguous symbols
+    :param all_outputs_ratio: fraction of queries converting to all
+        currencies
+    :param seed: random generator seed
+    """
+    rng = random.Random(seed)
+    if codes is None:
+        codes = fakeserver.RateTable().codes
+
+    inputs = list(codes) + sorted(UNIQUE_SYMBOLS)
+    outputs = list(codes) + sorted(UNIQUE_SYMBOLS)
+
+    queries = []
+    for _ in range(count):
+        input_currency = rng.choice(inputs)
+
+        if rng.random() < ambiguous_ratio:
+            output_currency = rng.choice(AMBIGUOUS_SYMBOLS)
+        elif rng.random() < all_outputs_ratio:
+            output_currency = None
+        else:
+            # converting a currency to itself is an input error, not load
+            base = UNIQUE_SYMBOLS.get(input_currency, input_currency)
+            output_currency = rng.choice(
+                [o for o in outputs if UNIQUE_SYMBOLS.get(o, o) != base])
+
+        queries.append({
+            'amount': round(rng.uniform(1, 10000), 2),
+            'input': input_currency,
+            'output': output_currency,
+        })
+
+    return queries
+
+
+def recorded_queries(path):
+    """
+    load queries from a file containing one JSON query per line
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+class LibraryTarget:
+    """
+    run queries through the application layer, constructing a new `App` for
+    each query
+    """
+    name = 'library'
+
+    def __call__(self, query):
+        outputs = [query['output']] if query.get('output') else []
+        return app.App(query['input']).convert(query['amount'], *outputs)
+
+
+class CLITarget:
+    """
+    run each query as a separate CLI process
+    """
+    name = 'cli'
+
+    def __call__(self, query):
+        args = [sys.executable, '-m', 'currencyconv.cli',
+                '--amount', str(query['amount']),
+                '--input_currency', query['input']]
+        if query.get('output'):
+            args.extend(['--output_currency', query['output']])
+
+        result = subprocess.run(
+            args, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            universal_newlines=True)
+        if result.returncode != 0:
+            stderr_lines = result.stderr.strip().splitlines()
+            raise RuntimeError(
+                stderr_lines[-1] if stderr_lines else
+                "CLI exited with code {}".format(result.returncode))
+
+        return json.loads(result.stdout)
+
+
+class ServerTarget:
+    """
+    send the rate table request for the query's input currency directly to
+    the rate API, bypassing any caching
+    """
+    name = 'server'
+
+    def __init__(self, source_url):
+        self.fetcher = fetch.RateFetcher(source_url, retries=0)
+        self.index = backend.SymbolIndex()
+
+    def __call__(self, query):
+        base = query['input']
+        codes = self.index.get(base)
+        if codes is not None and len(codes) == 1:
+            base = codes[0]
+
+        return self.fetcher.fetch(base)
+
+
+class Recorder:
+    """
+    thread-safe collector of query outcomes
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = []
+        self.service_times = []
+        self.errors = {}
+
+    def record(self, scheduled, started, finished, error=None):
+        with self._lock:
+            self.latencies.append(finished - scheduled)
+            self.service_times.append(finished - started)
+            if error is not None:
+                name = type(error).__name__
+                self.errors[name] = self.errors.get(name, 0) + 1
+
+
+def run_query(target, query, scheduled, recorder):
+    started = time.perf_counter()
+    error = None
+    try:
+        target(query)
+    except Exception as e:
+        logger.debug("Query %s failed: %s", query, e)
+        error = e
+
+    recorder.record(scheduled, started, time.perf_counter(), error=error)
+
+
+def run_threads(target, queries, rate, concurrency, recorder):
+    start = time.perf_counter()
+    with futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        pending = set()
+        for i, query in enumerate(queries):
+            if rate:
+                scheduled = start + i / rate
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            else:
+                # without a target rate send the next query as soon as there
+                # is a free worker
+                if len(pending) >= concurrency:
+                    done, pending = futures.wait(
+                        pending, return_when=futures.FIRST_COMPLETED)
+                scheduled = time.perf_counter()
+
+            pending.add(executor.submit(
+                run_query, target, query, scheduled, recorder))
+
+    return time.perf_counter() - start
+
+
+async def _run_tasks(target, queries, rate, concurrency, recorder):
+    loop = asyncio.get_running_loop()
+    executor = futures.ThreadPoolExecutor(max_workers=concurrency)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def task(query, scheduled, acquired):
+        if not acquired:
+            await semaphore.acquire()
+        try:
+            await loop.run_in_executor(
+                executor, run_query, target, query, scheduled, recorder)
+        finally:
+            semaphore.release()
+
+    start = time.perf_counter()
+    tasks = []
+    try:
+        for i, query in enumerate(queries):
+            acquired = False
+            if rate:
+                scheduled = start + i / rate
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            else:
+                # without a target rate send the next query as soon as there
+                # is a free worker
+                await semaphore.acquire()
+                acquired = True
+                scheduled = time.perf_counter()
+
+            tasks.append(asyncio.ensure_future(
+                task(query, scheduled, acquired)))
+
+        await asyncio.gather(*tasks)
+    finally:
+        executor.shutdown()
+
+    return time.perf_counter() - start
+
+
+def run_asyncio(target, queries, rate, concurrency, recorder):
+    return asyncio.run(
+        _run_tasks(target, queries, rate, concurrency, recorder))
+
+
+DRIVERS = {
+    'threads': run_threads,
+    'asyncio': run_asyncio,
+}
+
+
+def percentile(sorted_values, fraction):
+    """
+    return the nearest-rank percentile of the sorted values
+    """
+    if not sorted_values:
+        return None
+
+    rank = max(0, min(len(sorted_values) - 1,
+                      math.ceil(fraction * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+
+def summarize(values):
+    """
+    summarize durations in seconds as milliseconds
+    """
+    values = sorted(values)
+    if not values:
+        return {}
+
+    return {
+        'mean': 1000 * sum(values) / len(values),
+        'p50': 1000 * percentile(values, 0.50),
+        'p90': 1000 * percentile(values, 0.90),
+        'p99': 1000 * percentile(values, 0.99),
+        'max': 1000 * values[-1],
+    }
+
+
+def run(target, queries, mode='threads', rate=0.0, concurrency=8):
+    """
+    replay the queries against the target and return the report dictionary
+
+    :param target: callable executing a single query
+    :param queries: list of queries
+    :param mode: 'threads' or 'asyncio'
+    :param rate: target rate in queries per second, 0 for unthrottled
+    :param concurrency: maximum number of queries executing at once
+    """
+    recorder = Recorder()
+    duration = DRIVERS[mode](target, queries, rate, concurrency, recorder)
+    error_count = sum(recorder.errors.values())
+
+    return {
+        'target': getattr(target, 'name', str(target)),
+        'mode': mode,
+        'concurrency': concurrency,
+        'target_rate': rate,
+        'requests': len(recorder.latencies),
+        'errors': error_count,
+        'errors_by_type': recorder.errors,
+        'duration_s': duration,
+        'throughput_rps': len(recorder.latencies) / duration,
+        'latency_ms': summarize(recorder.latencies),
+        'service_time_ms': summarize(recorder.service_times),
+    }
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(
+        description="Replay conversion queries and report latency as JSON")
+    parser.add_argument(
+        '-t',
+        '--target',
+        choices=('library', 'cli', 'server'),
+        default='library',
+        help="What to run the queries against"
+    )
+    parser.add_argument(
+        '-m',
+        '--mode',
+        choices=sorted(DRIVERS),
+        default='threads',
+        help="Run queries from a thread pool or from asyncio tasks"
+    )
+    parser.add_argument(
+        '-r',
+        '--rate',
+        type=float,
+        default=0.0,
+        help="Target rate in queries per second (0 means unthrottled)"
+    )
+    parser.add_argument(
+        '-n',
+        '--requests',
+        type=int,
+        default=1000,
+        help="Number of synthetic queries to send"
+    )
+    parser.add_argument(
+        '-c',
+        '--concurrency',
+        type=int,
+        default=8,
+        help="Maximum number of queries executing at once"
+    )
+    parser.add_argument(
+        '-q',
+        '--queries',
+        metavar='FILE',
+        default=None,
+        help="Replay queries recorded in FILE (one JSON object per line) "
+             "instead of synthetic ones"
+    )
+    parser.add_argument(
+        '--ambiguous-ratio',
+        type=float,
+        default=0.1,
+        help="Fraction of synthetic queries using ambiguous symbols"
+    )
+    parser.add_argument(
+        '--seed',
+        type=int,
+        default=0,
+        help="Seed of the synthetic query generator"
+    )
+    parser.add_argument(
+        '--rates-url',
+        default=None,
+        help="Use rate API at this URL instead of the local fixture server"
+    )
+    parser.add_argument(
+        '--upstream-latency',
+        type=float,
+        default=0.0,
+        help="Latency of the local fixture server in seconds"
+    )
+    parser.add_argument(
+        '--upstream-error-rate',
+        type=float,
+        default=0.0,
+        help="Fraction of failing requests of the local fixture server"
+    )
+    parser.add_argument(
+        '-d',
+        '--debug',
+        action='store_true',
+        default=False,
+        help="Print verbose information"
+    )
+    return parser
+
+
+def make_target(name, source_url):
+    if name == 'cli':
+        return CLITarget()
+
+    if name == 'server':
+        return ServerTarget(source_url)
+
+    return LibraryTarget()
+
+
+def main(args=None):
+    args = make_parser().parse_args(args=args)
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.CRITICAL)
+
+    if args.queries is not None:
+        queries = recorded_queries(args.queries)
+    else:
+        queries = synthetic_queries(
+            args.requests, ambiguous_ratio=args.ambiguous_ratio,
+            seed=args.seed)
+
+    rate_server = None
+    source_url = args.rates_url
+    if source_url is None:
+        rate_server = fakeserver.FakeRateServer(
+            latency=args.upstream_latency,
+            error_rate=args.upstream_error_rate,
+            seed=args.seed).start()
+        source_url = rate_server.url
+
+    # the CLI target inherits the configuration through the environment
+    saved_source_url = os.environ.get(backend.RATES_URL_ENV)
+    os.environ[backend.RATES_URL_ENV] = source_url
+
+    try:
+        report = run(make_target(args.target, source_url), queries,
+                     mode=args.mode, rate=args.rate,
+                     concurrency=args.concurrency)
+        if args.target == 'library':
+            report['fetch_stats'] = backend.default_fetcher().stats.as_dict()
+            shared_cache = backend.default_shared_cache()
+            if shared_cache is not None:
+                report['shared_cache_stats'] = shared_cache.stats.as_dict()
+        if rate_server is not None:
+            report['upstream_requests'] = rate_server.request_count
+    finally:
+        if saved_source_url is None:
+            del os.environ[backend.RATES_URL_ENV]
+        else:
+            os.environ[backend.RATES_URL_ENV] = saved_source_url
+
+        if rate_server is not None:
+            rate_server.stop()
+
+    print(json.dumps(report, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,622 @@
+# Author: Martin Babinsky <martbab@gmail.com>
+# See LICENSE file for license
+
+"""
+Host-wide cache of rate tables in shared memory
+
+Worker processes on one host share fetched rate tables instead of each of
+them fetching and keeping its own copy. Only one process fetches a given table
+from upstream and publishes it, the others attach to the published shared
+memory segment and read the rates directly from it.
+
+Layout:
+
+* index segment `<name>-index` holds a fixed number of slots, one per base
+  currency. Each slot records the version, publication time and size of the
+  current table of the base. Slots are updated under a seqlock so that
+  readers never see a half-written slot. A slot left half-written by a
+  writer which died is repaired after a bounded wait.
+* table segment `<name>-<base>-<version>` holds a single published table.
+  Tables are immutable: a new version goes to a new segment and the old one is
+  unlinked, so readers attached to it keep a consistent snapshot.
+
+Publishing is serialized across processes by file locks.
+
+NOTE: relies on POSIX shared memory and file locking, i.e. Linux/Unix only
+"""
+
+from collections.abc import Mapping
+import contextlib
+import fcntl
+import logging
+from multiprocessing import resource_tracker, shared_memory
+import os
+import re
+import struct
+import sys
+import tempfile
+import threading
+import time
+
+from currencyconv import fetch
+
+logger = logging.getLogger(__name__)
+
+# base code, seqlock counter, version, publication time, table size
+_SLOT = struct.Struct('<8sQQdQ')
+_SLOT_BASE = struct.Struct('<8s')
+_SLOT_SEQ = struct.Struct('<Q')
+_SLOT_SEQ_OFFSET = 8
+_SLOT_DATA = struct.Struct('<QdQ')
+_SLOT_DATA_OFFSET = 16
+_SLOT_COUNT = 256
+
+# how long readers wait for a slot being written before assuming that the
+# writer died and repairing the slot
+_SLOT_WRITE_TIMEOUT = 1.0
+# how many times to try attaching to the table named by the index before
+# considering it gone
+_ATTACH_ATTEMPTS = 3
+
+# only 3-letter currency codes are shared, they fit the slot and are safe to
+# use in segment and lock file names
+_CODE_RE = re.compile(r'[A-Z]{3}\Z')
+# cache names must not contain the '-' separating the parts of segment and
+# lock file names, otherwise one cache could match the files of another one
+_NAME_RE = re.compile(r'[A-Za-z0-9_]+\Z')
+
+_TABLE_HEADER = struct.Struct('<Q')
+_TABLE_CODE = struct.Struct('<8s')
+_RATE = struct.Struct('<d')
+
+
+def _open_segment(name, create=False, size=0):
+    """
+    open shared memory segment which outlives the current process
+    """
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(
+            name, create=create, size=size, track=False)
+
+    shm = shared_memory.SharedMemory(name, create=create, size=size)
+    # the resource tracker would unlink the segment when this process exits
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm
+
+
+def _index_name(name):
+    return '{}-index'.format(name)
+
+
+def _table_name(name, base, version):
+    return '{}-{}-{}'.format(name, base, version)
+
+
+def _lock_path(name, lock_dir, base=None):
+    if base is not None:
+        name = '{}-{}'.format(name, base)
+    return os.path.join(lock_dir, '{}.lock'.format(name))
+
+
+def _check_name(name):
+    """
+    :raises: ValueError if `name` is not a valid cache name
+    """
+    if not isinstance(name, str) or _NAME_RE.match(name) is None:
+        raise ValueError(
+            "Invalid shared rate cache name '{}': only letters, digits and "
+            "underscores are allowed".format(name))
+
+
+def _is_code(base):
+    return isinstance(base, str) and _CODE_RE.match(base) is not None
+
+
+def _unpack_slot(buf, i):
+    """
+    return raw (base, seq, version, published_at, size) contents of the slot.
+    Base is None if it is not a valid currency code
+    """
+    base, seq, version, published_at, size = _SLOT.unpack_from(
+        buf, i * _SLOT.size)
+    try:
+        base = base.rstrip(b'\0').decode('ascii')
+    except UnicodeDecodeError:
+        base = None
+
+    if base and not _is_code(base):
+        base = None
+
+    return base, seq, version, published_at, size
+
+
+def _unlink_segment(name):
+    try:
+        shm = _open_segment(name)
+    except FileNotFoundError:
+        return
+
+    shm.close()
+    if sys.version_info < (3, 13):
+        # unlink() unregisters the segment from the resource tracker, which
+        # has to know about it
+        resource_tracker.register(shm._name, 'shared_memory')
+    shm.unlink()
+
+
+@contextlib.contextmanager
+def _file_lock(path, blocking=True):
+    """
+    hold exclusive lock on `path`, yield False if `blocking` is False and the
+    lock is held by someone else
+    """
+    with open(path, 'a') as f:
+        flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+        try:
+            fcntl.flock(f, flags)
+        except BlockingIOError:
+            yield False
+            return
+
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class SharedCacheFull(Exception):
+    """
+    Raised when there is no free slot in the index for another base currency
+    """
+    pass
+
+
+class SharedCacheStats(fetch.FetchStats):
+    """
+    Counters describing the behavior of the shared cache in this process
+
+    * fresh_hits: lookups served from a fresh published table
+    * stale_hits: lookups served from a stale table while revalidating
+    * fallbacks: lookups served from a table because the upstream failed
+    * refreshes: background revalidations started
+    * publishes: tables fetched and published by this process
+    """
+    FIELDS = ('fresh_hits', 'stale_hits', 'fallbacks', 'refreshes',
+              'publishes')
+
+
+class SharedRates(Mapping):
+    """
+    read-only view of a rate table published in shared memory. Rates are read
+    from the segment on access, only the codes are copied to the process
+    """
+    def __init__(self, shm, version):
+        self._shm = shm
+        self.version = version
+
+        count, = _TABLE_HEADER.unpack_from(shm.buf, 0)
+        self._codes = {}
+        for i in range(count):
+            code, = _TABLE_CODE.unpack_from(
+                shm.buf, _TABLE_HEADER.size + i * _TABLE_CODE.size)
+            self._codes[code.rstrip(b'\0').decode('ascii')] = i
+
+        self._rates_offset = _TABLE_HEADER.size + count * _TABLE_CODE.size
+
+    @staticmethod
+    def size(rates):
+        return _TABLE_HEADER.size + len(rates) * (
+            _TABLE_CODE.size + _RATE.size)
+
+    @staticmethod
+    def write(buf, rates):
+        """
+        serialize the rate dictionary into the buffer
+        """
+        _TABLE_HEADER.pack_into(buf, 0, len(rates))
+        rates_offset = _TABLE_HEADER.size + len(rates) * _TABLE_CODE.size
+        for i, (code, rate) in enumerate(sorted(rates.items())):
+            _TABLE_CODE.pack_into(
+                buf, _TABLE_HEADER.size + i * _TABLE_CODE.size,
+                code.encode('ascii'))
+            _RATE.pack_into(buf, rates_offset + i * _RATE.size, rate)
+
+    def __getitem__(self, code):
+        i = self._codes[code]
+        return _RATE.unpack_from(
+            self._shm.buf, self._rates_offset + i * _RATE.size)[0]
+
+    def __contains__(self, code):
+        return code in self._codes
+
+    def __len__(self):
+        return len(self._codes)
+
+    def __iter__(self):
+        return iter(self._codes)
+
+
+class SharedRateCache:
+    """
+    Rate tables shared by all processes on the host using the same `name`
+
+    Only bases which are 3-letter currency codes are shared, anything else is
+    passed to the fetcher directly.
+
+    :param fetcher: `fetch.RateFetcher` used to fetch the tables from
+        upstream. Its `max_age` and `max_stale` settings apply to the shared
+        tables as well
+    :param name: name of the cache, used as prefix of shared memory segments
+        and lock files. Only letters, digits and underscores are allowed
+    :param lock_dir: directory for the lock files
+    :raises: ValueError if the name is invalid
+    """
+    def __init__(self, fetcher, name='currencyconv', lock_dir=None):
+        _check_name(name)
+        self.fetcher = fetcher
+        self.name = name
+        self.lock_dir = lock_dir if lock_dir is not None else (
+            tempfile.gettempdir())
+        self.stats = SharedCacheStats()
+
+        self._index = self._open_index()
+        self._attached = {}
+        self._lock = threading.Lock()
+        self._refreshing = set()
+
+    def _lock_path(self, base=None):
+        return _lock_path(self.name, self.lock_dir, base=base)
+
+    def _open_index(self):
+        size = _SLOT.size * _SLOT_COUNT
+        while True:
+            try:
+                # a fresh segment is zero-filled, i. e. all slots are empty
+                return _open_segment(
+                    _index_name(self.name), create=True, size=size)
+            except FileExistsError:
+                pass
+
+            try:
+                return _open_segment(_index_name(self.name))
+            except FileNotFoundError:
+                # unlinked in the meantime
+                pass
+            except ValueError:
+                # the creator did not set the size of the segment yet
+                time.sleep(0.001)
+
+    def _index_is_current(self):
+        """
+        return True if the attached index is still the one published under
+        the cache name, i. e. the cache was not unlinked in the meantime
+        """
+        try:
+            current = _open_segment(_index_name(self.name))
+        except (FileNotFoundError, ValueError):
+            return False
+
+        try:
+            current_stat = os.fstat(current._fd)
+            attached_stat = os.fstat(self._index._fd)
+            return ((current_stat.st_dev, current_stat.st_ino) ==
+                    (attached_stat.st_dev, attached_stat.st_ino))
+        finally:
+            current.close()
+
+    def _reattach_index(self):
+        """
+        attach to the index published under the cache name, creating it if
+        needed. Must be called with the index lock held
+        """
+        logger.info("Index of shared rate cache '%s' was removed, "
+                    "reattaching", self.name)
+        index = self._open_index()
+        with self._lock:
+            # versions of the old index mean nothing in the new one
+            self._attached.clear()
+            self._index = index
+
+    def _repair_slot(self, index, i):
+        """
+        fix up slot left half-written by a writer which died. Must be called
+        with the index lock held
+        """
+        base, seq, version, _, _ = _unpack_slot(index.buf, i)
+        offset = i * _SLOT.size
+        logger.warning("Repairing slot %d of shared rate cache '%s' left "
+                       "half-written", i, self.name)
+
+        if not base:
+            # the writer died while allocating the slot, nothing was
+            # published in it
+            _SLOT.pack_into(index.buf, offset, b'', seq + 1, 0, 0.0, 0)
+            return '', 0, 0.0, 0
+
+        # both the old and the new version refer to a complete table, but mark
+        # it as expired so that it gets replaced
+        _SLOT.pack_into(index.buf, offset, base.encode('ascii'), seq + 1,
+                        version, 0.0, 0)
+        return base, version, 0.0, 0
+
+    def _read_slot(self, i, locked=False):
+        """
+        return consistent (base, version, published_at, size) contents of the
+        slot
+
+        :param locked: True if the caller holds the index lock
+        """
+        index = self._index
+        offset = i * _SLOT.size
+        deadline = None
+        while True:
+            base, seq, version, published_at, size = _unpack_slot(
+                index.buf, i)
+            if (not seq % 2 and seq == _SLOT_SEQ.unpack_from(
+                    index.buf, offset + _SLOT_SEQ_OFFSET)[0]):
+                return base, version, published_at, size
+
+            if locked:
+                # nobody can be writing, the writer must have died
+                return self._repair_slot(index, i)
+
+            if deadline is None:
+                deadline = time.monotonic() + _SLOT_WRITE_TIMEOUT
+            elif time.monotonic() > deadline:
+                with _file_lock(self._lock_path()):
+                    return self._read_slot(i, locked=True)
+
+            # writer in progress
+            time.sleep(0.0001)
+
+    def _write_slot(self, i, base, version, published_at, size):
+        """
+        update the slot, must be called with the index lock held
+        """
+        buf = self._index.buf
+        offset = i * _SLOT.size
+        seq_offset = offset + _SLOT_SEQ_OFFSET
+        seq = _SLOT_SEQ.unpack_from(buf, seq_offset)[0]
+
+        _SLOT_SEQ.pack_into(buf, seq_offset, seq + 1)
+        _SLOT_BASE.pack_into(buf, offset, base.encode('ascii'))
+        _SLOT_DATA.pack_into(buf, offset + _SLOT_DATA_OFFSET, version,
+                             published_at, size)
+        _SLOT_SEQ.pack_into(buf, seq_offset, seq + 2)
+
+    def _find_slot(self, base, locked=False):
+        for i in range(_SLOT_COUNT):
+            slot = self._read_slot(i, locked=locked)
+            if slot[0] == base:
+                return i, slot
+            if not slot[0]:
+                break
+
+        return None, None
+
+    def _snapshot(self, base):
+        """
+        return published_at and attached table of `base`, (None, None) if
+        there is nothing published
+        """
+        for _ in range(_ATTACH_ATTEMPTS):
+            _, slot = self._find_slot(base)
+            if slot is None or not slot[1]:
+                return None, None
+
+            _, version, published_at, _ = slot
+            with self._lock:
+                rates = self._attached.get(base)
+                if rates is not None and rates.version == version:
+                    return published_at, rates
+
+            try:
+                shm = _open_segment(_table_name(self.name, base, version))
+            except FileNotFoundError:
+                # superseded by a newer version in the meantime
+                continue
+
+            rates = SharedRates(shm, version)
+            with self._lock:
+                self._attached[base] = rates
+            return published_at, rates
+
+        # the table was removed from under the index, e. g. by unlink()
+        logger.debug("Version %d of '%s' rates is gone", version, base)
+        return None, None
+
+    def _publish(self, base, rates):
+        with _file_lock(self._lock_path()):
+            if not self._index_is_current():
+                self._reattach_index()
+
+            i, slot = self._find_slot(base, locked=True)
+            if i is None:
+                i = next((j for j in range(_SLOT_COUNT)
+                          if not self._read_slot(j, locked=True)[0]), None)
+                if i is None:
+                    raise SharedCacheFull(
+                        "No free slot for '{}' rates".format(base))
+                old_version = 0
+            else:
+                old_version = slot[1]
+
+            version = old_version + 1
+            size = SharedRates.size(rates)
+            name = _table_name(self.name, base, version)
+            try:
+                shm = _open_segment(name, create=True, size=size)
+            except FileExistsError:
+                # left over by a process which died while publishing
+                _unlink_segment(name)
+                shm = _open_segment(name, create=True, size=size)
+
+            SharedRates.write(shm.buf, rates)
+            shm.close()
+
+            self._write_slot(i, base, version, time.time(), size)
+            if old_version:
+                _unlink_segment(_table_name(self.name, base, old_version))
+
+        self.stats.increment('publishes')
+        logger.debug("Published version %d of '%s' rates", version, base)
+
+    def _fetch_and_publish(self, base, blocking=True):
+        """
+        fetch and publish `base` rates unless another process already did so
+
+        :returns: False if `blocking` is False and another process is
+            fetching the rates right now
+        """
+        with _file_lock(self._lock_path(base), blocking=blocking) as locked:
+            if not locked:
+                return False
+
+            published_at, _ = self._snapshot(base)
+            if (published_at is not None and
+                    time.time() - published_at < self.fetcher.max_age):
+                return True
+
+            self._publish(base, self.fetcher.fetch(base))
+            return True
+
+    def _refresh(self, base):
+        try:
+            self._fetch_and_publish(base, blocking=False)
+        except (fetch.FetchError, SharedCacheFull) as e:
+            logger.warning("Background refresh of '%s' rates failed: %s",
+                           base, e)
+        finally:
+            with self._lock:
+                self._refreshing.discard(base)
+
+    def refresh_in_background(self, base):
+        """
+        start refreshing `base` rates in a background thread unless there is
+        one already running in this process or the circuit breaker of the
+        fetcher would reject it
+
+        :returns: the started thread or None
+        """
+        if not self.fetcher.circuit_breaker.would_allow():
+            self.fetcher.stats.increment('circuit_rejections')
+            return None
+
+        with self._lock:
+            if base in self._refreshing:
+                return None
+            self._refreshing.add(base)
+
+        self.stats.increment('refreshes')
+        thread = threading.Thread(
+            target=self._refresh, args=(base,),
+            name='shared-rate-refresh-{}'.format(base), daemon=True)
+        thread.start()
+        return thread
+
+    def get_rates(self, base):
+        """
+        return the rates for `base` from the shared cache, fetching and
+        publishing them if needed. Stale tables are served while being
+        revalidated and, if the upstream fails, tables of any age are served
+        instead.
+
+        :raises: fetch.UnknownBase if the upstream does not know the base
+            currency, fetch.UpstreamUnavailable if the rates could not be
+            fetched and nothing is published
+        """
+        if not _is_code(base):
+            # let the upstream judge it, without touching shared resources
+            return self.fetcher.get_rates(base)
+
+        published_at, rates = self._snapshot(base)
+        if rates is not None:
+            age = time.time() - published_at
+            if age < self.fetcher.max_age:
+                self.stats.increment('fresh_hits')
+                return rates
+
+            if age < self.fetcher.max_age + self.fetcher.max_stale:
+                self.stats.increment('stale_hits')
+                self.refresh_in_background(base)
+                return rates
+
+        try:
+            self._fetch_and_publish(base)
+        except fetch.UpstreamUnavailable as e:
+            if rates is None:
+                raise
+
+            self.stats.increment('fallbacks')
+            logger.warning(
+                "%s, falling back to '%s' rates published %.0f s ago",
+                e, base, time.time() - published_at)
+            return rates
+        except SharedCacheFull as e:
+            logger.warning("%s, not sharing the rates", e)
+            return self.fetcher.get_rates(base)
+
+        rates = self._snapshot(base)[1]
+        if rates is None:
+            # removed right after publishing, the fetcher has a copy
+            return self.fetcher.get_rates(base)
+
+        return rates
+
+    def close(self):
+        """
+        detach from the shared memory of this process
+        """
+        with self._lock:
+            self._attached.clear()
+
+        self._index.close()
+
+    def unlink(self):
+        """
+        remove the cache from the host, see `unlink`
+        """
+        unlink(self.name, lock_dir=self.lock_dir)
+
+
+def unlink(name='currencyconv', lock_dir=None):
+    """
+    remove the shared memory segments and lock files of the cache `name` from
+    the host. Processes which are attached keep their snapshots and publish
+    into a new index when they fetch rates next time
+
+    :param lock_dir: directory with the lock files, the same as used by the
+        cache
+    :raises: ValueError if the name is invalid
+    """
+    _check_name(name)
+    if lock_dir is None:
+        lock_dir = tempfile.gettempdir()
+
+    with _file_lock(_lock_path(name, lock_dir)):
+        try:
+            index = _open_segment(_index_name(name))
+        except (FileNotFoundError, ValueError):
+            index = None
+
+        if index is not None:
+            for i in range(_SLOT_COUNT):
+                base, _, version, _, _ = _unpack_slot(index.buf, i)
+                if not base:
+                    break
+                if version:
+                    _unlink_segment(_table_name(name, base, version))
+
+            index.close()
+            _unlink_segment(_index_name(name))
+
+    # only '<name>.lock' and '<name>-<base>.lock' belong to the cache, the
+    # lock files of caches with names sharing the prefix are left alone
+    for path in os.listdir(lock_dir):
+        lock_name, suffix = os.path.splitext(path)
+        if suffix != '.lock':
+            continue
+
+        cache_name, _, base = lock_name.partition('-')
+        if lock_name == name or cache_name == name and _is_code(base):
+            os.remove(os.path.join(lock_dir, path))
@@ -24,7 +24,7 @@ setup(
             'currency-converter=currencyconv.cli:main'
         ]
     },
-    install_requires=['pytest', 'forex-python'],
+    install_requires=['pytest', 'forex-python', 'requests'],
     license='GPLv3+',
     name='currency-converter',
     package_data={
@@ -0,0 +1,43 @@
+# Author: Martin Babinsky <martbab@gmail.com>
+# See LICENSE file for license
+
+"""
+Fixtures shared by all tests
+"""
+import pytest
+
+from currencyconv import backend, fakeserver
+
+
+@pytest.fixture()
+def rate_server_factory():
+    """
+    factory starting local stand-in rate servers, all of them are stopped at
+    the end of the test
+    """
+    servers = []
+
+    def factory(**kwargs):
+        kwargs.setdefault('seed', 0)
+        server = fakeserver.FakeRateServer(**kwargs).start()
+        servers.append(server)
+        return server
+
+    yield factory
+
+    for server in servers:
+        server.stop()
+
+
+@pytest.fixture()
+def rate_server(rate_server_factory):
+    yield rate_server_factory()
+
+
+@pytest.fixture()
+def offline_rates(monkeypatch, rate_server):
+    """
+    point the whole stack to the local stand-in rate server
+    """
+    monkeypatch.setenv(backend.RATES_URL_ENV, rate_server.url)
+    yield rate_server
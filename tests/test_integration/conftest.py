@@ -0,0 +1,12 @@
+# Author: Martin Babinsky <martbab@gmail.com>
+# See LICENSE file for license
+
+"""
+Fixtures pointing the whole stack to the local stand-in rate server
+"""
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def offline_stack(offline_rates):
+    yield offline_rates
@@ -5,6 +5,7 @@
 Integration test executing the whole stack
 """
 import json
+import os
 
 from forex_python.converter import CurrencyRates
 import pytest
@@ -12,6 +13,18 @@ import pytest
 from currencyconv import app, backend, cli
 
 
+class ReferenceRates(CurrencyRates):
+    """
+    forex_python rate fetcher querying the rate API the stack is pointed to,
+    used as an independent reference of the conversion results
+
+    NOTE: this class overrides internal implementation details of forex_python
+    package and may break anytime
+    """
+    def _source_url(self):
+        return os.environ[backend.RATES_URL_ENV]
+
+
 class TestCLI:
 
     def run_cli(self, args):
@@ -26,7 +39,7 @@ class TestCLI:
             assert msg in str(e.value)
 
     def assert_conversion(self, args):
-        currency_rates = CurrencyRates()
+        currency_rates = ReferenceRates()
         result = self.run_cli(args)
 
         amount = result['input']['amount']
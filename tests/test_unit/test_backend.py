@@ -5,10 +5,11 @@
 Basic unit tests for the backend
 """
 import random
+import uuid
 
 import pytest
 
-from currencyconv import backend
+from currencyconv import backend, shmcache
 
 
 example_rates = {
@@ -92,3 +93,115 @@ class TestIndex:
 
     def test_retrieval_of_multiple_code_mapping(self, symbol_index):
         assert sorted(symbol_index["$"]) == ["ARS", "AUD"]
+
+
+@pytest.yield_fixture(params=[
+    (backend.TIMEOUT_ENV, 'fast'),
+    (backend.TIMEOUT_ENV, '0'),
+    (backend.TIMEOUT_ENV, 'nan'),
+    (backend.TIMEOUT_ENV, 'inf'),
+    (backend.RETRIES_ENV, '1.5'),
+    (backend.RETRIES_ENV, '-1'),
+])
+def invalid_env(request, monkeypatch):
+    name, value = request.param
+    monkeypatch.setenv(name, value)
+    yield name
+
+
+class TestDefaultFetcher:
+    def test_invalid_configuration_raises_error(self, invalid_env):
+        with pytest.raises(backend.ConfigurationError) as exc:
+            backend.default_fetcher()
+
+        assert invalid_env in str(exc.value)
+
+
+@pytest.yield_fixture()
+def offline_backend(monkeypatch, offline_rates):
+    monkeypatch.setenv(backend.RETRIES_ENV, '0')
+    yield offline_rates
+
+
+class TestDefaultConverter:
+    def test_conversion_uses_fetched_rates(self, offline_backend):
+        conv = backend.default_converter('EUR')
+        assert conv.rates == offline_backend.table.get_rates('EUR')
+
+    def test_upstream_failure_raises_rates_not_available(
+            self, offline_backend):
+        offline_backend.error_rate = 1.0
+        with pytest.raises(backend.RatesNotAvailable):
+            backend.default_converter('EUR')
+
+    def test_unreachable_upstream_raises_rates_not_available(
+            self, offline_backend):
+        offline_backend.stop()
+        with pytest.raises(backend.RatesNotAvailable):
+            backend.default_converter('EUR')
+
+    def test_unknown_base_raises_unknown_currency_code(self, offline_backend):
+        with pytest.raises(backend.UnknownCurrencyCode):
+            backend.default_converter('LOL')
+
+
+@pytest.yield_fixture()
+def shared_cache_env(monkeypatch, offline_backend):
+    """
+    factory configuring a new uniquely named shared cache, the caches are
+    removed from the host at the end of the test
+    """
+    names = []
+
+    def factory():
+        name = 'currencyconv_test_{}'.format(uuid.uuid4().hex[:8])
+        names.append(name)
+        monkeypatch.setenv(backend.SHM_CACHE_ENV, name)
+        return name
+
+    yield factory
+
+    for name in names:
+        shmcache.unlink(name)
+
+
+class TestDefaultSharedCache:
+    def test_unconfigured_cache_is_none(self, monkeypatch):
+        monkeypatch.delenv(backend.SHM_CACHE_ENV, raising=False)
+        assert backend.default_shared_cache() is None
+
+    def test_invalid_name_raises_error(self, monkeypatch):
+        monkeypatch.setenv(backend.SHM_CACHE_ENV, '../rates')
+        with pytest.raises(backend.ConfigurationError) as exc:
+            backend.default_shared_cache()
+
+        assert backend.SHM_CACHE_ENV in str(exc.value)
+
+    def test_converter_uses_shared_rates(
+            self, shared_cache_env, offline_backend):
+        shared_cache_env()
+        conv = backend.default_converter('EUR')
+        backend.default_converter('EUR')
+
+        assert isinstance(conv.rates, shmcache.SharedRates)
+        assert dict(conv.rates) == offline_backend.table.get_rates('EUR')
+        assert backend.default_shared_cache().stats.publishes == 1
+        assert offline_backend.request_count == 1
+
+    def test_replaced_cache_is_closed(self, monkeypatch, shared_cache_env):
+        shared_cache_env()
+        old_cache = backend.default_shared_cache()
+        closed = []
+        close = old_cache.close
+
+        def spy_close():
+            closed.append(True)
+            close()
+
+        monkeypatch.setattr(old_cache, 'close', spy_close)
+
+        shared_cache_env()
+        new_cache = backend.default_shared_cache()
+
+        assert new_cache is not old_cache
+        assert closed == [True]
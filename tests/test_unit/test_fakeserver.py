@@ -0,0 +1,72 @@
+# Author: Martin Babinsky <martbab@gmail.com>
+# See LICENSE file for license
+
+"""
+Unit tests for the stand-in rate server
+"""
+import pytest
+
+from currencyconv import fakeserver
+
+
+example_rates = {
+    "EUR": 1.0,
+    "USD": 2.0,
+    "CZK": 25.0,
+}
+
+
+@pytest.yield_fixture()
+def rate_table():
+    yield fakeserver.RateTable(example_rates)
+
+
+@pytest.yield_fixture()
+def make_server(rate_server_factory):
+    def factory(**kwargs):
+        return rate_server_factory(
+            table=fakeserver.RateTable(example_rates), **kwargs)
+
+    yield factory
+
+
+class TestRateTable:
+    def test_rates_exclude_base(self, rate_table):
+        assert sorted(rate_table.get_rates('USD')) == ['CZK', 'EUR']
+
+    def test_cross_rates(self, rate_table):
+        rates = rate_table.get_rates('USD')
+        assert abs(rates['CZK'] - 12.5) < 1e-9
+        assert abs(rates['EUR'] - 0.5) < 1e-9
+
+    def test_unknown_base_raises_keyerror(self, rate_table):
+        with pytest.raises(KeyError):
+            rate_table.get_rates('LOL')
+
+
+class TestFakeRateServer:
+    def test_serves_rates(self, make_server):
+        status, payload, _ = make_server().handle('/api/latest?base=EUR')
+        assert status == 200
+        assert payload['base'] == 'EUR'
+        assert payload['date'] == 'latest'
+        assert payload['rates'] == {"USD": 2.0, "CZK": 25.0}
+
+    def test_unknown_base_returns_bad_request(self, make_server):
+        status, _, _ = make_server().handle('/api/latest?base=LOL')
+        assert status == 400
+
+    def test_errors_are_injected(self, make_server):
+        server = make_server(error_rate=1.0)
+        status, _, _ = server.handle('/api/latest?base=EUR')
+        assert status == 503
+        assert server.error_count == 1
+
+    def test_requests_over_limit_are_rejected(self, make_server):
+        server = make_server(rate_limit=2, rate_limit_window=60.0)
+        statuses = [server.handle('/api/latest?base=EUR')[0]
+                    for _ in range(3)]
+
+        assert statuses == [200, 200, 429]
+        assert server.rate_limited_count == 1
+        assert server.request_count == 3
@@ -0,0 +1,203 @@
+# Author: Martin Babinsky <martbab@gmail.com>
+# See LICENSE file for license
+
+"""
+Unit tests for the resilient fetch layer
+"""
+import threading
+
+import pytest
+
+from currencyconv import fetch
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeResponse:
+    def __init__(self, status_code, payload=None):
+        self.status_code = status_code
+        self.payload = payload
+
+    def json(self):
+        return self.payload
+
+
+@pytest.yield_fixture()
+def clock():
+    yield FakeClock()
+
+
+@pytest.yield_fixture()
+def fetcher(rate_server, clock):
+    f = fetch.RateFetcher(
+        rate_server.url, timeout=1.0, retries=2, max_age=10.0,
+        max_stale=100.0, clock=clock, sleep=lambda delay: None)
+    yield f
+
+
+class TestCircuitBreaker:
+    def test_opens_after_threshold(self, clock):
+        breaker = fetch.CircuitBreaker(
+            failure_threshold=2, reset_timeout=5.0, clock=clock)
+        breaker.record_failure()
+        assert breaker.allow()
+
+        breaker.record_failure()
+        assert breaker.state == breaker.OPEN
+        assert not breaker.allow()
+
+    def test_half_open_lets_single_trial_through(self, clock):
+        breaker = fetch.CircuitBreaker(
+            failure_threshold=1, reset_timeout=5.0, clock=clock)
+        breaker.record_failure()
+
+        clock.now = 5.0
+        assert breaker.allow()
+        assert not breaker.allow()
+
+        breaker.record_success()
+        assert breaker.state == breaker.CLOSED
+
+    def test_would_allow_does_not_take_trial(self, clock):
+        breaker = fetch.CircuitBreaker(
+            failure_threshold=1, reset_timeout=5.0, clock=clock)
+        breaker.record_failure()
+        assert not breaker.would_allow()
+
+        clock.now = 5.0
+        assert breaker.would_allow()
+        assert breaker.allow()
+        assert not breaker.would_allow()
+
+    def test_failed_trial_reopens_circuit(self, clock):
+        breaker = fetch.CircuitBreaker(
+            failure_threshold=1, reset_timeout=5.0, clock=clock)
+        breaker.record_failure()
+
+        clock.now = 5.0
+        assert breaker.allow()
+        breaker.record_failure()
+        assert breaker.state == breaker.OPEN
+
+
+class TestRateFetcher:
+    def test_fetches_rates(self, fetcher, rate_server):
+        assert fetcher.get_rates('EUR') == rate_server.table.get_rates('EUR')
+
+    def test_unknown_base_is_not_retried(self, fetcher, rate_server):
+        with pytest.raises(fetch.UnknownBase):
+            fetcher.get_rates('LOL')
+
+        assert rate_server.request_count == 1
+
+    @pytest.mark.parametrize('status', [401, 403, 404])
+    def test_rejected_request_is_upstream_failure(
+            self, fetcher, monkeypatch, status):
+        monkeypatch.setattr(
+            fetcher._session, 'get', lambda *a, **kw: FakeResponse(status))
+        with pytest.raises(fetch.UpstreamRejected):
+            fetcher.get_rates('EUR')
+
+        assert fetcher.stats.requests == 1
+        assert fetcher.stats.failures == 1
+
+    def test_non_object_response_is_upstream_failure(
+            self, fetcher, monkeypatch):
+        monkeypatch.setattr(
+            fetcher._session, 'get',
+            lambda *a, **kw: FakeResponse(200, payload=['EUR']))
+        fetcher.retries = 0
+        with pytest.raises(fetch.UpstreamUnavailable):
+            fetcher.get_rates('EUR')
+
+    def test_failures_are_retried(self, fetcher, rate_server):
+        rate_server.error_rate = 1.0
+        with pytest.raises(fetch.UpstreamUnavailable):
+            fetcher.get_rates('EUR')
+
+        assert rate_server.request_count == 3
+        assert fetcher.stats.retries == 2
+        assert fetcher.stats.failures == 1
+
+    def test_timeout_is_upstream_failure(self, fetcher, rate_server):
+        rate_server.latency = 0.5
+        fetcher.timeout = 0.05
+        fetcher.retries = 0
+        with pytest.raises(fetch.UpstreamUnavailable):
+            fetcher.get_rates('EUR')
+
+    def test_open_circuit_fails_fast(self, fetcher, rate_server):
+        rate_server.error_rate = 1.0
+        fetcher.circuit_breaker.failure_threshold = 3
+        with pytest.raises(fetch.UpstreamUnavailable):
+            fetcher.get_rates('EUR')
+
+        with pytest.raises(fetch.CircuitOpen):
+            fetcher.get_rates('EUR')
+
+        assert rate_server.request_count == 3
+        assert fetcher.stats.circuit_rejections == 1
+
+    def test_circuit_opening_during_retries_is_failure(
+            self, fetcher, rate_server):
+        rate_server.error_rate = 1.0
+        fetcher.circuit_breaker.failure_threshold = 2
+        with pytest.raises(fetch.CircuitOpen):
+            fetcher.get_rates('EUR')
+
+        assert rate_server.request_count == 2
+        assert fetcher.stats.failures == 1
+
+    def test_fresh_rates_are_cached(self, fetcher, rate_server):
+        fetcher.get_rates('EUR')
+        fetcher.get_rates('EUR')
+
+        assert rate_server.request_count == 1
+        assert fetcher.stats.fresh_hits == 1
+
+    def test_stale_rates_are_served_while_revalidating(
+            self, fetcher, rate_server, clock):
+        rates = fetcher.get_rates('EUR')
+        rate_server.latency = 0.2
+
+        clock.now = 20.0
+        assert fetcher.get_rates('EUR') is rates
+        assert fetcher.stats.stale_hits == 1
+        assert fetcher.stats.refreshes == 1
+
+        for thread in threading.enumerate():
+            if thread.name == 'rate-refresh-EUR':
+                thread.join()
+
+        assert rate_server.request_count == 2
+        assert fetcher.get_rates('EUR') is not rates
+
+    def test_open_circuit_skips_background_refresh(
+            self, fetcher, rate_server, clock):
+        rates = fetcher.get_rates('EUR')
+        rate_server.error_rate = 1.0
+        fetcher.retries = 0
+        fetcher.circuit_breaker.failure_threshold = 1
+        with pytest.raises(fetch.UpstreamUnavailable):
+            fetcher.fetch('EUR')
+
+        clock.now = 20.0
+        assert fetcher.get_rates('EUR') is rates
+        assert fetcher.get_rates('EUR') is rates
+        assert fetcher.stats.refreshes == 0
+        assert fetcher.stats.circuit_rejections == 2
+
+    def test_cached_rates_are_fallback_on_failure(
+            self, fetcher, rate_server, clock):
+        rates = fetcher.get_rates('EUR')
+        rate_server.error_rate = 1.0
+
+        clock.now = 1000.0
+        assert fetcher.get_rates('EUR') is rates
+        assert fetcher.stats.fallbacks == 1
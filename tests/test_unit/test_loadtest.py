@@ -0,0 +1,114 @@
+# Author: Martin Babinsky <martbab@gmail.com>
+# See LICENSE file for license
+
+"""
+Unit tests for the load-testing driver
+"""
+import json
+import os
+import subprocess
+
+import pytest
+
+from currencyconv import backend, loadtest
+
+
+class FailingTarget:
+    name = 'failing'
+
+    def __call__(self, query):
+        if query['input'] == 'LOL':
+            raise KeyError(query['input'])
+
+
+example_queries = [
+    {'amount': 1.0, 'input': 'EUR', 'output': 'USD'},
+    {'amount': 2.0, 'input': 'LOL', 'output': None},
+    {'amount': 3.0, 'input': 'CZK', 'output': '$'},
+]
+
+
+@pytest.yield_fixture(params=sorted(loadtest.DRIVERS))
+def mode(request):
+    yield request.param
+
+
+class TestSyntheticQueries:
+    def test_queries_are_deterministic(self):
+        assert (loadtest.synthetic_queries(50, seed=1) ==
+                loadtest.synthetic_queries(50, seed=1))
+
+    def test_ambiguous_ratio(self):
+        queries = loadtest.synthetic_queries(50, ambiguous_ratio=1.0)
+        assert all(q['output'] in loadtest.AMBIGUOUS_SYMBOLS
+                   for q in queries)
+
+    def test_output_differs_from_input(self):
+        queries = loadtest.synthetic_queries(
+            500, ambiguous_ratio=0.0, all_outputs_ratio=0.0, seed=2)
+
+        def resolve(currency):
+            return loadtest.UNIQUE_SYMBOLS.get(currency, currency)
+
+        assert all(resolve(q['input']) != resolve(q['output'])
+                   for q in queries)
+
+
+class TestTargets:
+    def test_library_target_runs_offline(self, offline_rates, mode):
+        queries = loadtest.synthetic_queries(50, seed=3)
+        report = loadtest.run(
+            loadtest.LibraryTarget(), queries, mode=mode, concurrency=4)
+
+        assert report['requests'] == 50
+        assert report['errors_by_type'] == {}
+
+    def test_cli_target_reports_exit_code_without_stderr(self, monkeypatch):
+        def killed_process(args, **kwargs):
+            return subprocess.CompletedProcess(args, -9, '', '')
+
+        monkeypatch.setattr(subprocess, 'run', killed_process)
+        with pytest.raises(RuntimeError) as exc:
+            loadtest.CLITarget()(example_queries[0])
+
+        assert 'exited with code -9' in str(exc.value)
+
+
+class TestReport:
+    def test_percentile(self):
+        values = list(range(1, 101))
+        assert loadtest.percentile(values, 0.5) == 50
+        assert loadtest.percentile(values, 0.99) == 99
+        assert loadtest.percentile([1, 2, 3, 4, 5], 0.5) == 3
+        assert loadtest.percentile([1, 2, 3, 4, 5], 0.9) == 5
+        assert loadtest.percentile([], 0.5) is None
+
+    def test_run_reports_all_queries(self, mode):
+        report = loadtest.run(
+            FailingTarget(), example_queries * 10, mode=mode, concurrency=4)
+
+        assert report['target'] == 'failing'
+        assert report['requests'] == 30
+        assert report['errors_by_type'] == {'KeyError': 10}
+        assert set(report['latency_ms']) == {'mean', 'p50', 'p90', 'p99',
+                                             'max'}
+
+    def test_run_at_target_rate(self, mode):
+        report = loadtest.run(
+            FailingTarget(), example_queries * 5, mode=mode, rate=300.0)
+
+        # 15 queries at 300 per second take at least 14 / 300 s
+        assert report['duration_s'] >= 14 / 300.0
+
+
+class TestMain:
+    def test_report_of_offline_run(self, monkeypatch, capsys):
+        monkeypatch.delenv(backend.RATES_URL_ENV, raising=False)
+        loadtest.main(['--requests', '40', '--concurrency', '4'])
+
+        report = json.loads(capsys.readouterr().out)
+        assert report['target'] == 'library'
+        assert report['requests'] == 40
+        assert report['errors'] == 0
+        assert report['upstream_requests'] > 0
+        assert backend.RATES_URL_ENV not in os.environ
@@ -0,0 +1,229 @@
+# Author: Martin Babinsky <martbab@gmail.com>
+# See LICENSE file for license
+
+"""
+Unit tests for the shared memory rate cache
+"""
+import multiprocessing
+import os
+import uuid
+
+import pytest
+
+from currencyconv import fetch, shmcache
+
+
+@pytest.yield_fixture()
+def cache_name(tmpdir):
+    name = 'currencyconv_test_{}'.format(uuid.uuid4().hex[:8])
+    yield name
+    shmcache.unlink(name, lock_dir=str(tmpdir))
+
+
+@pytest.yield_fixture()
+def make_cache(rate_server, cache_name, tmpdir):
+    """
+    factory of cache handles backed by `rate_server`, each of them behaves as
+    a separate worker process
+    """
+    caches = []
+
+    def factory(**kwargs):
+        fetcher = fetch.RateFetcher(rate_server.url, **kwargs)
+        cache = shmcache.SharedRateCache(
+            fetcher, name=cache_name, lock_dir=str(tmpdir))
+        caches.append(cache)
+        return cache
+
+    yield factory
+
+    for cache in caches:
+        cache.close()
+
+
+def shm_segments(cache_name):
+    return sorted(name for name in os.listdir('/dev/shm')
+                  if name.startswith(cache_name + '-'))
+
+
+def worker_get_rates(url, cache_name, lock_dir, queue):
+    fetcher = fetch.RateFetcher(url)
+    cache = shmcache.SharedRateCache(
+        fetcher, name=cache_name, lock_dir=lock_dir)
+    queue.put(dict(cache.get_rates('EUR')))
+    cache.close()
+
+
+class TestSharedRateCache:
+    def test_published_rates_match_upstream(
+            self, rate_server, make_cache):
+        cache = make_cache()
+        rates = cache.get_rates('EUR')
+
+        assert dict(rates) == rate_server.table.get_rates('EUR')
+        assert cache.stats.publishes == 1
+
+    def test_other_handles_attach_to_published_rates(
+            self, rate_server, make_cache):
+        publisher = make_cache()
+        reader = make_cache()
+
+        publisher.get_rates('EUR')
+        rates = reader.get_rates('EUR')
+
+        assert dict(rates) == rate_server.table.get_rates('EUR')
+        assert reader.stats.fresh_hits == 1
+        assert reader.stats.publishes == 0
+        assert rate_server.request_count == 1
+
+    def test_new_version_does_not_change_attached_snapshot(
+            self, rate_server, make_cache):
+        cache = make_cache(max_age=0.0, max_stale=0.0)
+        old_rates = cache.get_rates('EUR')
+        old_usd = old_rates['USD']
+
+        rate_server.table.eur_rates['USD'] = 2.0
+        new_rates = cache.get_rates('EUR')
+
+        assert new_rates.version == old_rates.version + 1
+        assert new_rates['USD'] == 2.0
+        assert old_rates['USD'] == old_usd
+
+    def test_unknown_base_raises_error(
+            self, make_cache):
+        cache = make_cache()
+        with pytest.raises(fetch.UnknownBase):
+            cache.get_rates('LOL')
+
+    def test_invalid_base_bypasses_shared_resources(
+            self, make_cache, cache_name, tmpdir):
+        cache = make_cache()
+        for base in ('a/b', 'LOLLOLLOLLOL', 'Kč'):
+            with pytest.raises(fetch.UnknownBase):
+                cache.get_rates(base)
+
+        assert os.listdir(str(tmpdir)) == []
+        assert shm_segments(cache_name) == [cache_name + '-index']
+
+    def test_invalid_name_raises_error(self, rate_server, tmpdir):
+        fetcher = fetch.RateFetcher(rate_server.url)
+        for name in ('', 'a/b', 'rates-prod', 'kurzy_Kč', None):
+            with pytest.raises(ValueError):
+                shmcache.SharedRateCache(
+                    fetcher, name=name, lock_dir=str(tmpdir))
+
+            with pytest.raises(ValueError):
+                shmcache.unlink(name, lock_dir=str(tmpdir))
+
+        assert os.listdir(str(tmpdir)) == []
+
+    def test_removed_table_is_republished(
+            self, rate_server, make_cache, cache_name, tmpdir):
+        publisher = make_cache()
+        reader = make_cache()
+        publisher.get_rates('EUR')
+        shmcache.unlink(cache_name, lock_dir=str(tmpdir))
+
+        rates = reader.get_rates('EUR')
+
+        assert dict(rates) == rate_server.table.get_rates('EUR')
+        assert shm_segments(cache_name) == [
+            cache_name + '-EUR-1', cache_name + '-index']
+
+    def test_unlink_removes_only_own_lock_files(
+            self, rate_server, make_cache, cache_name, tmpdir):
+        other_name = cache_name + '_prod'
+        other = shmcache.SharedRateCache(
+            fetch.RateFetcher(rate_server.url), name=other_name,
+            lock_dir=str(tmpdir))
+        foreign_lock = tmpdir.join(cache_name + '-backup.lock')
+        foreign_lock.write('')
+        try:
+            make_cache().get_rates('EUR')
+            other.get_rates('EUR')
+            shmcache.unlink(cache_name, lock_dir=str(tmpdir))
+
+            assert shm_segments(cache_name) == []
+            assert shm_segments(other_name) == [
+                other_name + '-EUR-1', other_name + '-index']
+            assert sorted(os.listdir(str(tmpdir))) == sorted([
+                foreign_lock.basename, other_name + '-EUR.lock',
+                other_name + '.lock'])
+        finally:
+            other.close()
+            other.unlink()
+
+    def test_publishing_after_unlink_uses_new_index(
+            self, make_cache, cache_name, tmpdir):
+        cache = make_cache(max_age=0.0, max_stale=0.0)
+        cache.get_rates('EUR')
+        cache.get_rates('EUR')
+        shmcache.unlink(cache_name, lock_dir=str(tmpdir))
+
+        cache.get_rates('EUR')
+
+        assert shm_segments(cache_name) == [
+            cache_name + '-EUR-1', cache_name + '-index']
+
+    def test_half_written_slot_is_repaired(
+            self, monkeypatch, rate_server, make_cache):
+        monkeypatch.setattr(shmcache, '_SLOT_WRITE_TIMEOUT', 0.01)
+        dead_writer = make_cache()
+        reader = make_cache()
+        dead_writer.get_rates('EUR')
+
+        # simulate a writer which died in the middle of updating the slot
+        seq_offset = shmcache._SLOT_SEQ_OFFSET
+        seq, = shmcache._SLOT_SEQ.unpack_from(
+            dead_writer._index.buf, seq_offset)
+        shmcache._SLOT_SEQ.pack_into(
+            dead_writer._index.buf, seq_offset, seq + 1)
+
+        rates = reader.get_rates('EUR')
+
+        assert dict(rates) == rate_server.table.get_rates('EUR')
+        assert reader.stats.publishes == 1
+        seq, = shmcache._SLOT_SEQ.unpack_from(reader._index.buf, seq_offset)
+        assert seq % 2 == 0
+
+    def test_open_circuit_skips_background_refresh(
+            self, rate_server, make_cache):
+        cache = make_cache(max_age=0.0, retries=0)
+        rates = cache.get_rates('EUR')
+        rate_server.error_rate = 1.0
+        cache.fetcher.circuit_breaker.failure_threshold = 1
+        with pytest.raises(fetch.UpstreamUnavailable):
+            cache.fetcher.fetch('EUR')
+
+        assert dict(cache.get_rates('EUR')) == dict(rates)
+        assert cache.stats.refreshes == 0
+        assert cache.fetcher.stats.circuit_rejections == 1
+
+    def test_published_rates_are_fallback_on_failure(
+            self, rate_server, make_cache):
+        cache = make_cache(max_age=0.0, max_stale=0.0, retries=0)
+        rates = cache.get_rates('EUR')
+        rate_server.error_rate = 1.0
+
+        assert cache.get_rates('EUR') is rates
+        assert cache.stats.fallbacks == 1
+
+    def test_worker_processes_share_single_fetch(
+            self, rate_server, cache_name, tmpdir):
+        context = multiprocessing.get_context('fork')
+        queue = context.Queue()
+        workers = [
+            context.Process(
+                target=worker_get_rates,
+                args=(rate_server.url, cache_name, str(tmpdir), queue))
+            for _ in range(4)]
+
+        for worker in workers:
+            worker.start()
+        results = [queue.get(timeout=10) for _ in workers]
+        for worker in workers:
+            worker.join()
+
+        expected = rate_server.table.get_rates('EUR')
+        assert all(result == expected for result in results)
+        assert rate_server.request_count == 1